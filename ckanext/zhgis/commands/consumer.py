@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import inspect
+import multiprocessing
+import os
+import resource
+import signal
+import time
+
+from ckan import model
+
+import logging
+log = logging.getLogger(__name__)
+
+# the queue name, consumer factory and callback of ckanext.harvest.queue
+QUEUES = {
+    'gather': (
+        'ckan.harvest.gather', 'get_gather_consumer', 'gather_callback'
+    ),
+    'fetch': ('ckan.harvest.fetch', 'get_fetch_consumer', 'fetch_callback'),
+}
+
+
+class BatchedAckChannel(object):
+    """
+        Proxy of a consumer channel passed to the harvest callbacks.
+        The acks of the callbacks are collected and sent at once for
+        every ack_batch messages, acknowledging all messages up to the
+        last acked one. The worker flushes the remaining acks as soon
+        as the queue is idle.
+    """
+    def __init__(self, channel, ack_batch=1):
+        self._channel = channel
+        self.ack_batch = ack_batch
+        self._delivery_tag = None
+        self._pending = 0
+
+    def __repr__(self):
+        return (
+            "<BatchedAckChannel ack_batch:%s pending:%s>"
+            % (self.ack_batch, self._pending)
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if self.ack_batch <= 1:
+            return self._channel.basic_ack(delivery_tag, multiple)
+        # the delivery tags of a channel are increasing
+        self._delivery_tag = delivery_tag
+        self._pending += 1
+        if self._pending >= self.ack_batch:
+            self.flush()
+
+    def flush(self):
+        """ Sends the collected acks """
+        if self._pending:
+            self._channel.basic_ack(self._delivery_tag, True)
+            self._pending = 0
+
+
+def get_rss():
+    """ Returns the resident memory of the process in bytes or None """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+class Worker(object):
+    """
+        Consumes the messages of a harvest queue one after the other.
+        The broker delivers up to prefetch messages in advance.
+        On SIGTERM, the current message is finished before the worker
+        exits. After max_messages messages or once its resident memory
+        exceeds max_memory bytes, the worker exits the same way to be
+        restarted by the supervisor.
+        Acks are only batched if the consumer returns when no message
+        arrived within ack_timeout seconds, so they are never kept
+        pending on an idle queue.
+    """
+    def __init__(self, queue, prefetch=10, ack_batch=1, max_messages=0,
+                 max_memory=0, ack_timeout=5):
+        self.queue = queue
+        self.prefetch = prefetch
+        self.ack_batch = ack_batch
+        self.ack_timeout = ack_timeout
+        self.max_messages = max_messages
+        self.max_memory = max_memory
+        self.messages = 0
+        self._busy = False
+        self._stopping = False
+
+    def __repr__(self):
+        return (
+            "<Worker queue:%s prefetch:%s ack_batch:%s max_messages:%s "
+            "max_memory:%s>"
+            % (self.queue, self.prefetch, self.ack_batch, self.max_messages,
+               self.max_memory)
+        )
+
+    def __call__(self):
+        self.run()
+
+    def run(self):
+        from ckanext.harvest import queue as harvest_queue
+
+        signal.signal(signal.SIGTERM, self._stop)
+        queue_name, get_consumer, callback_name = QUEUES[self.queue]
+        consumer = getattr(harvest_queue, get_consumer)()
+        callback = getattr(harvest_queue, callback_name)
+
+        ack_batch = 1
+        consume_args = {'queue': queue_name}
+        if hasattr(consumer, 'basic_qos'):
+            # only AMQP channels support prefetch and multiple acks
+            consumer.basic_qos(prefetch_count=self.prefetch)
+            ack_batch = max(1, min(self.ack_batch, self.prefetch))
+        if ack_batch > 1:
+            if self._supports_inactivity_timeout(consumer):
+                consume_args['inactivity_timeout'] = self.ack_timeout
+            else:
+                log.warning(
+                    'The consumer cannot wait for idle queues, '
+                    'every message is acknowledged on its own'
+                )
+                ack_batch = 1
+        channel = BatchedAckChannel(consumer, ack_batch)
+
+        try:
+            for message in consumer.consume(**consume_args):
+                if message is None or message[0] is None:
+                    # no message within the inactivity timeout, depending
+                    # on the pika version None or a tuple of None
+                    channel.flush()
+                    continue
+                method, header, body = message
+                self._busy = True
+                callback(channel, method, header, body)
+                self.after_message()
+                self._busy = False
+                if self._stopping:
+                    break
+        finally:
+            try:
+                channel.flush()
+            except Exception, e:
+                log.exception(e)
+
+    def _supports_inactivity_timeout(self, consumer):
+        try:
+            args = inspect.getargspec(consumer.consume).args
+        except TypeError:
+            return False
+        return 'inactivity_timeout' in args
+
+    def after_message(self):
+        """
+            Recycles the session and frees the objects of the message,
+            so the memory of the worker stays flat
+        """
+        model.Session.remove()
+        gc.collect()
+        self.messages += 1
+
+        rss = get_rss()
+        log.info(
+            'Worker %s: %s messages, RSS %s'
+            % (os.getpid(), self.messages,
+               '%.1f MB' % (rss / 1048576.0) if rss is not None else 'n/a')
+        )
+        if self.max_messages and self.messages >= self.max_messages:
+            log.info('Worker %s reached %s messages, exiting'
+                     % (os.getpid(), self.messages))
+            self._stopping = True
+        if self.max_memory and rss is not None and rss > self.max_memory:
+            log.info('Worker %s exceeded %s bytes, exiting'
+                     % (os.getpid(), self.max_memory))
+            self._stopping = True
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        if not self._busy:
+            raise SystemExit(0)
+
+
+def supervise(worker, workers, restart_delay=5):
+    """
+        Runs the worker in the given number of processes and restarts
+        every process which exits, until SIGTERM or SIGINT is received.
+        The processes are then stopped and awaited.
+    """
+    processes = {}
+    started = {}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    def start(index):
+        process = multiprocessing.Process(
+            target=worker,
+            name='%s-%s' % (worker.queue, index)
+        )
+        process.start()
+        processes[index] = process
+        started[index] = time.time()
+        log.info('Started worker %s (pid %s)' % (process.name, process.pid))
+
+    # the processes must not share the database connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        start(index)
+
+    while not stopping:
+        for index, process in processes.items():
+            if (not process.is_alive() and
+                    time.time() - started[index] >= restart_delay):
+                log.warning(
+                    'Worker %s exited with %s, restarting'
+                    % (process.name, process.exitcode)
+                )
+                start(index)
+        time.sleep(1)
+
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    for process in processes.values():
+        process.join()
+
+
+def run_consumer(queue, workers=1, prefetch=10, ack_batch=1, max_messages=0,
+                 max_memory=0):
+    """
+        Consumes the harvest queue, in supervised worker processes
+        if there is more than one worker or the workers are limited
+    """
+    worker = Worker(queue, prefetch, ack_batch, max_messages, max_memory)
+    if workers > 1 or max_messages or max_memory:
+        supervise(worker, workers)
+    else:
+        worker.run()
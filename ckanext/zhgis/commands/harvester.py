@@ -1,5 +1,6 @@
 import sys
 import re
+import time
 from pprint import pprint
 
 from ckan import model
@@ -34,25 +35,47 @@ class Harvester(CkanCommand):
       harvester run
         - runs harvest jobs
 
-      harvester gather_consumer
+      harvester [--workers={n}] [--prefetch={n}] [--ack-batch={n}]
+                [--max-messages={n}] [--max-memory={mb}] gather_consumer
         - starts the consumer for the gathering queue
 
-      harvester fetch_consumer
+      harvester [--workers={n}] [--prefetch={n}] [--ack-batch={n}]
+                [--max-messages={n}] [--max-memory={mb}] fetch_consumer
         - starts the consumer for the fetching queue
 
+          The --workers flag runs the consumer in the given number of processes, which are
+          restarted when they exit. The --prefetch flag sets the number of messages the
+          queue delivers to a worker in advance (default: 10), the --ack-batch flag the
+          number of messages acknowledged at once (default: 1). Pending acks are sent as
+          soon as the queue is idle for 5 seconds, consumers which cannot wait for an idle
+          queue acknowledge every message on its own.
+
+          The --max-messages and --max-memory flags restart a worker after the given number
+          of messages or once it uses more than the given MB of resident memory.
+
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
-      harvester [-j] [--segments={segments}] import [{source-id}]
+      harvester [-j] [--segments={segments}] [--parallel={n}] [--batch-size={size} [--force]] import [{source-id}]
         - perform the import stage with the last fetched objects, optionally belonging to a certain source.
           Please note that no objects will be fetched from the remote server. It will only affect
-          the last fetched objects already present in the database.
+          the last fetched objects already present in the database. The objects are loaded
+          page by page and the progress is printed after every page.
 
           If the -j flag is provided, the objects are not joined to existing datasets. This may be useful
           when importing objects for the first time.
 
           The --segments flag allows to define a string containing hex digits that represent which of
           the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f
+          The segment of an object is the first hex digit of the md5 of its id.
+
+          The --parallel flag splits the segments across the given number of processes, each
+          with its own database connection.
+
+          The --batch-size flag imports the objects in batches of the given size within one
+          transaction each, the search index is updated once per batch. An object failing
+          to import is rolled back on its own. Unchanged packages are skipped unless the
+          --force flag is provided.
 
       harvester job-all
         - create new harvest jobs for all active sources.
@@ -85,6 +108,30 @@ class Harvester(CkanCommand):
 '''A string containing hex digits that represent which of
  the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f''')
 
+        self.parser.add_option('--parallel', dest='parallel', type='int',
+            default=1, help='Number of processes importing the segments')
+
+        self.parser.add_option('--batch-size', dest='batch_size', type='int',
+            default=0, help='Import the objects in transactions of this many objects')
+
+        self.parser.add_option('--force', dest='force_import', action='store_true',
+            default=False, help='Save unchanged packages during a batch import')
+
+        self.parser.add_option('--workers', dest='workers', type='int',
+            default=1, help='Number of consumer processes')
+
+        self.parser.add_option('--prefetch', dest='prefetch', type='int',
+            default=10, help='Number of messages delivered to a consumer in advance')
+
+        self.parser.add_option('--ack-batch', dest='ack_batch', type='int',
+            default=1, help='Number of messages acknowledged at once')
+
+        self.parser.add_option('--max-messages', dest='max_messages', type='int',
+            default=0, help='Restart a consumer process after this many messages')
+
+        self.parser.add_option('--max-memory', dest='max_memory', type='int',
+            default=0, help='Restart a consumer process using more than this many MB')
+
     def command(self):
         self._load_config()
 
@@ -112,20 +159,14 @@ class Harvester(CkanCommand):
             self.list_harvest_jobs()
         elif cmd == 'run':
             self.run_harvester()
-        elif cmd == 'gather_consumer':
+        elif cmd in ('gather_consumer', 'fetch_consumer'):
             import logging
-            from ckanext.harvest.queue import get_gather_consumer, gather_callback
+            from ckanext.zhgis.commands.consumer import run_consumer
             logging.getLogger('amqplib').setLevel(logging.INFO)
-            consumer = get_gather_consumer()
-            for method, header, body in consumer.consume(queue='ckan.harvest.gather'):
-                gather_callback(consumer, method, header, body)
-        elif cmd == 'fetch_consumer':
-            import logging
-            logging.getLogger('amqplib').setLevel(logging.INFO)
-            from ckanext.harvest.queue import get_fetch_consumer, fetch_callback
-            consumer = get_fetch_consumer()
-            for method, header, body in consumer.consume(queue='ckan.harvest.fetch'):
-               fetch_callback(consumer, method, header, body)
+            run_consumer(cmd.split('_')[0], self.options.workers,
+                         self.options.prefetch, self.options.ack_batch,
+                         self.options.max_messages,
+                         self.options.max_memory * 1024 * 1024)
         elif cmd == 'purge_queues':
             from ckanext.harvest.queue import purge_queues
             purge_queues()
@@ -273,14 +314,277 @@ class Harvester(CkanCommand):
         else:
             source_id = None
 
-        context = {'model': model, 'session':model.Session, 'user': self.admin_user['name'],
-                   'join_datasets': not self.options.no_join_datasets,
-                   'segments': self.options.segments}
-
+        if source_id:
+            self._check_import_source(source_id)
 
-        objs = get_action('harvest_objects_import')(context,{'source_id':source_id})
-
-        print '%s objects reimported' % len(objs)
+        if self.options.parallel > 1:
+            imported, errors, stats = self.import_stage_parallel(source_id, self.options.parallel)
+        else:
+            imported, errors, stats = self._import_objects(source_id)
+
+        print '%s objects reimported' % imported
+        if errors:
+            print '%s objects failed to import' % errors
+        if stats:
+            print '%(created)s packages created, %(updated)s updated, %(skipped)s skipped' % stats
+
+    def _check_import_source(self, source_id):
+        from ckan.logic import NotFound
+        from ckanext.harvest.model import HarvestSource
+
+        source = HarvestSource.get(source_id)
+        if not source:
+            raise NotFound('Harvest source %s does not exist' % source_id)
+        if not source.active:
+            raise Exception('This harvest source is not active')
+
+    def _import_objects(self, source_id):
+        if self.options.batch_size > 0:
+            return self.import_stage_batched(source_id, self.options.batch_size)
+        return self.import_stage_streamed(source_id)
+
+    def import_stage_streamed(self, source_id, page_size=100):
+        '''
+        Imports the current harvest objects like harvest_objects_import,
+        but loads them page by page instead of all at once. Every object
+        is committed and indexed by its harvester.
+        '''
+        harvesters = {}
+        imported = 0
+        errors = 0
+        total = self._get_import_query(source_id).count()
+        started = time.time()
+
+        for objs in self._iter_import_objects(source_id, page_size):
+            for obj in objs:
+                obj_id = obj.id
+                harvester = self._get_harvester(obj.source.type, harvesters)
+                try:
+                    if harvester.import_stage(obj):
+                        imported += 1
+                    else:
+                        errors += 1
+                        print 'Error importing object %s, see the object errors' % obj_id
+                except Exception, e:
+                    model.Session.rollback()
+                    errors += 1
+                    print 'Error importing object %s: %r' % (obj_id, e)
+            self._print_progress(imported, errors, total, started)
+
+        return imported, errors, None
+
+    def import_stage_parallel(self, source_id, parallel):
+        '''
+        Splits the segments to import across the given number of processes
+        and returns the total of their imported objects, errors and stats.
+        '''
+        import multiprocessing
+        import Queue
+
+        segments = self.options.segments or '0123456789abcdef'
+        groups = [segments[i::parallel] for i in range(parallel) if segments[i::parallel]]
+
+        # the processes must not share the database connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        results = multiprocessing.Queue()
+        pending = {}
+        for group in groups:
+            process = multiprocessing.Process(
+                target=self._import_segments,
+                args=(source_id, group, results),
+                name='import-%s' % group
+            )
+            process.start()
+            pending[group] = process
+            print 'Importing segments %s (pid %s)' % (group, process.pid)
+
+        imported = 0
+        errors = 0
+        stats = None
+        while pending:
+            try:
+                group, count, failed, group_stats = results.get(timeout=1)
+            except Queue.Empty:
+                # a process exiting normally has always sent its result
+                for group, process in pending.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        print 'Import of segments %s exited with %s' % (group, process.exitcode)
+                        errors += 1
+                        del pending[group]
+                continue
+            pending.pop(group).join()
+            imported += count
+            errors += failed
+            if group_stats:
+                stats = stats or dict.fromkeys(group_stats, 0)
+                for action, value in group_stats.items():
+                    stats[action] += value
+            print 'Segments %s: %s objects imported, %s errors' % (group, count, failed)
+
+        return imported, errors, stats
+
+    def _import_segments(self, source_id, segments, results):
+        self.options.segments = segments
+        try:
+            imported, errors, stats = self._import_objects(source_id)
+        except Exception, e:
+            print 'Error importing segments %s: %r' % (segments, e)
+            imported, errors, stats = 0, 1, None
+        finally:
+            model.Session.remove()
+        results.put((segments, imported, errors, stats))
+
+    def import_stage_batched(self, source_id, batch_size):
+        '''
+        Imports the current harvest objects like harvest_objects_import,
+        but commits and updates the search index once per batch. Every
+        object is imported within a savepoint, so a failing object is
+        rolled back without affecting the rest of its batch.
+        '''
+        from ckan import plugins
+        from ckanext.harvest.model import HarvestObject
+
+        session = model.Session
+        harvesters = {}
+        imported = 0
+        errors = 0
+        stats = {'created': 0, 'updated': 0, 'skipped': 0}
+        total = self._get_import_query(source_id).count()
+        started = time.time()
+
+        # the packages are indexed once per batch instead of on every change
+        plugins.unload('synchronous_search')
+        try:
+            for objs in self._iter_import_objects(source_id, batch_size):
+                package_ids = []
+                self._prefetch_packages(objs, harvesters)
+                for obj_id in [obj.id for obj in objs]:
+                    # the objects are in the identity map of the session
+                    obj = session.query(HarvestObject).get(obj_id)
+                    harvester = self._get_batch_harvester(obj.source.type, harvesters)
+                    # the CKAN actions roll back the session on errors, which
+                    # already rolls back this savepoint but never the batch
+                    savepoint = session.begin_nested()
+                    try:
+                        if not harvester.import_stage(obj):
+                            raise Exception('Import failed, see the object errors')
+                        savepoint.commit()
+                        imported += 1
+                        action = getattr(harvester, 'last_import_action', None)
+                        if action in stats:
+                            stats[action] += 1
+                        if action != 'skipped':
+                            package_ids.append(obj.package_id)
+                    except Exception, e:
+                        if savepoint.is_active:
+                            savepoint.rollback()
+                        errors += 1
+                        print 'Error importing object %s: %r' % (obj_id, e)
+                session.commit()
+                self._index_packages(package_ids)
+                self._print_progress(imported, errors, total, started)
+        finally:
+            for harvester in harvesters.values():
+                harvester.defer_commit = False
+                harvester.prefetch_packages([])
+            plugins.load('synchronous_search')
+
+        return imported, errors, stats
+
+    def _get_import_query(self, source_id):
+        from sqlalchemy import func
+        from ckanext.harvest.model import HarvestObject, HarvestSource
+
+        query = model.Session.query(HarvestObject.id) \
+            .join(HarvestSource, HarvestSource.id == HarvestObject.harvest_source_id) \
+            .filter(HarvestSource.active == True) \
+            .filter(HarvestObject.current == True)
+        if source_id:
+            query = query.filter(HarvestObject.harvest_source_id == source_id)
+        if not self.options.no_join_datasets:
+            query = query.join(model.Package, model.Package.id == HarvestObject.package_id) \
+                .filter(model.Package.state == u'active')
+        if self.options.segments:
+            query = query.filter(
+                func.substr(func.md5(HarvestObject.id), 1, 1).in_(list(self.options.segments))
+            )
+        return query.order_by(HarvestObject.id)
+
+    def _iter_import_objects(self, source_id, page_size):
+        '''
+        Yields the harvest objects to import in pages ordered by id. Every
+        page is queried from the last id of the previous one and the session
+        is emptied in between, so only one page of objects is ever loaded.
+        '''
+        from ckanext.harvest.model import HarvestObject
+
+        session = model.Session
+        last_id = None
+        while True:
+            query = self._get_import_query(source_id)
+            if last_id is not None:
+                query = query.filter(HarvestObject.id > last_id)
+            page_ids = [obj_id for obj_id, in query.limit(page_size)]
+            if not page_ids:
+                break
+            session.expunge_all()
+            yield session.query(HarvestObject) \
+                .filter(HarvestObject.id.in_(page_ids)) \
+                .order_by(HarvestObject.id).all()
+            last_id = page_ids[-1]
+
+    def _print_progress(self, imported, errors, total, started):
+        elapsed = time.time() - started
+        rate = (imported + errors) / elapsed if elapsed else 0
+        print '%s of %s objects imported, %s errors (%.1f objects/s)' % (imported, total, errors, rate)
+
+    def _prefetch_packages(self, objs, harvesters):
+        guids_by_type = {}
+        for obj in objs:
+            guids_by_type.setdefault(obj.source.type, []).append(obj.guid)
+        for source_type, guids in guids_by_type.items():
+            self._get_batch_harvester(source_type, harvesters).prefetch_packages(guids)
+
+    def _get_harvester(self, source_type, harvesters, force_import=True):
+        if source_type not in harvesters:
+            from ckanext.harvest.interfaces import IHarvester
+            from ckan.plugins import PluginImplementations
+            for harvester in PluginImplementations(IHarvester):
+                if harvester.info()['name'] == source_type:
+                    break
+            else:
+                raise Exception('No harvester found for %s' % source_type)
+            if hasattr(harvester, 'force_import'):
+                harvester.force_import = force_import
+            harvesters[source_type] = harvester
+        return harvesters[source_type]
+
+    def _get_batch_harvester(self, source_type, harvesters):
+        if source_type not in harvesters:
+            harvester = self._get_harvester(source_type, harvesters, self.options.force_import)
+            if not hasattr(harvester, 'defer_commit'):
+                del harvesters[source_type]
+                raise Exception('The %s harvester does not support batches' % source_type)
+            harvester.defer_commit = True
+        return harvesters[source_type]
+
+    def _index_packages(self, package_ids):
+        from ckan.lib import search
+        from ckan.logic import NotFound
+
+        package_index = search.index_for(model.Package)
+        for package_id in package_ids:
+            context = {'model': model, 'ignore_auth': True, 'validate': False,
+                       'use_cache': False}
+            try:
+                package_dict = get_action('package_show')(context, {'id': package_id})
+            except NotFound:
+                print 'Package %s not found, not indexed' % package_id
+                continue
+            package_index.update_dict(package_dict, defer_commit=True)
+        search.commit()
 
     def create_harvest_job_all(self):
         context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session}
@@ -1,10 +1,19 @@
 import ckan.lib.cli
+import os
 import sys
+import time
 from pprint import pprint
+from lxml import etree
 
 from ckanext.zhgis.helpers import s3
 from ckanext.zhgis.helpers import ckan_csw
 
+BENCHMARK_FIXTURE = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)),
+    'fixtures',
+    'geocat_records.xml'
+)
+
 
 class ZhGisCommand(ckan.lib.cli.CkanCommand):
     '''Command to handle zhgis data
@@ -31,6 +40,12 @@ class ZhGisCommand(ckan.lib.cli.CkanCommand):
         # of a dataset like '38d5c3c9-ff3f-447a-b11d-aa80472246b6'
         paster zhgis cswid <query>
 
+        # Measure the records/second of the CSW mapping with the compiled
+        # XPaths and with xml.xpath per attribute as before, 'path' is a
+        # GetRecordById response, by default the fixture constructed in
+        # the che schema of geocat.ch
+        paster zhgis benchmark [<path>] [<iterations>]
+
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -43,6 +58,7 @@ class ZhGisCommand(ckan.lib.cli.CkanCommand):
             'list': self.listCmd,
             'csw': self.cswCmd,
             'cswid': self.cswIdCmd,
+            'benchmark': self.benchmarkCmd,
             'help': self.helpCmd,
         }
 
@@ -69,7 +85,7 @@ class ZhGisCommand(ckan.lib.cli.CkanCommand):
         csw = ckan_csw.ZhGisCkanMetadata()
         metadata = csw.get_ckan_metadata(query, lang)
         del metadata['metadata_raw']
-        pprint(metadata)
+        pprint(dict(metadata))
 
     def cswIdCmd(self, query=None, lang='de'):
         if (query is None):
@@ -79,7 +95,36 @@ class ZhGisCommand(ckan.lib.cli.CkanCommand):
         csw = ckan_csw.ZhGisCkanMetadata()
         metadata = csw.get_ckan_metadata_by_id(query, lang)
         del metadata['metadata_raw']
-        pprint(metadata)
+        pprint(dict(metadata))
+
+    def benchmarkCmd(self, path=BENCHMARK_FIXTURE, iterations=100):
+        iterations = int(iterations)
+        csw = ckan_csw.ZhGisCkanMetadata()
+        engine = csw.get_engine()
+        records = [
+            record_xml for record_id, record_xml
+            in csw.split_records(etree.parse(path).getroot())
+        ]
+
+        def run(compiled):
+            engine.clear()
+            ckan_csw.AnchorCache._xpaths.clear()
+            ckan_csw.XPathAttribute.compiled = compiled
+            try:
+                start = time.time()
+                for i in range(iterations):
+                    for record_xml in records:
+                        dict(csw.get_ckan_metadata_by_xml(record_xml))
+                return time.time() - start
+            finally:
+                ckan_csw.XPathAttribute.compiled = True
+
+        count = iterations * len(records)
+        for label, compiled in (('uncompiled', False), ('compiled', True)):
+            duration = run(compiled)
+            print "%-10s: %s records in %.3fs (%.1f records/s)" % (
+                label, count, duration, count / duration
+            )
 
     def importCmd(self):
         raise NotImplementedError
@@ -1,15 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+from multiprocessing.pool import ThreadPool
+from paste.deploy.converters import asbool
+from pylons import config
+from sqlalchemy.orm import subqueryload, subqueryload_all
+
 from ckan import model
 from ckan.model import Session
-from ckan.logic import get_action, action
+from ckan.logic import get_action, action, NotFound, ValidationError
 from ckan.lib.helpers import json
-from ckan.lib.munge import munge_title_to_name
+from ckan.lib.munge import munge_title_to_name, munge_tag
+from ckan.lib.navl.validators import ignore_missing, ignore
+from ckan.logic.schema import default_create_package_schema
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import (
+    HarvestJob,
+    HarvestGatherError,
+    HarvestObject,
+    HarvestObjectError,
+    HarvestObjectExtra
+)
 from ckanext.harvest.harvesters import HarvesterBase
 
 from ckanext.zhgis.helpers import ckan_csw
+from ckanext.zhgis.helpers.blob_store import store_metadata_raw
+from ckanext.zhgis.helpers.fetch_queue import FetchQueue
 
 import logging
 log = logging.getLogger(__name__)
@@ -21,6 +37,35 @@ class ZhGisHarvester(HarvesterBase):
     '''
     HARVEST_USER = u'harvest'
 
+    # the ids resolved by _get_resolved_ids, reset for every job or, in the
+    # reimports of the zhgis_harvest command, for every source and after
+    # a failed import
+    _resolved_ids = None
+
+    # set by the batch import of the zhgis_harvest command, import_stage
+    # then neither commits nor updates the search index
+    defer_commit = False
+
+    # set by harvest_objects_import, unchanged packages are saved anyway
+    force_import = False
+
+    # package extra with the hash of the harvested package_dict
+    CONTENT_HASH_KEY = 'zhgis_content_hash'
+
+    # part of the fingerprints, bump it whenever the mapping of the records
+    # in ckan_csw or in this harvester changes, so all records are mapped
+    # again by the next job
+    MAPPING_VERSION = 1
+
+    # the number of created, updated and skipped packages of the last job
+    import_stats = None
+
+    # created, updated or skipped, the result of the last import_stage
+    last_import_action = None
+
+    # the packages loaded by prefetch_packages by id
+    _packages = None
+
     DATASETS = {
         'c80f283d-6ab8-4ce4-a480-c7995c575b24': {
             'geolion_url': 'http://www.geolion.zh.ch/geodatenservice/show?nbid=994',  # noqa
@@ -433,46 +478,428 @@ class ZhGisHarvester(HarvesterBase):
     def gather_stage(self, harvest_job):
         log.debug('In ZhGisHarvester gather_stage')
 
-        ids = []
-        for dataset_id, dataset in self.DATASETS.iteritems():
+        if self._is_forced_remap():
+            previous_fingerprints = {}
+        else:
+            previous_fingerprints = self._get_previous_fingerprints(
+                harvest_job.source_id
+            )
+        dataset_ids = self._get_dataset_ids(harvest_job, previous_fingerprints)
+        queue = FetchQueue(
+            int(config.get('ckanext.zhgis.gather_batch_size', 0))
+        )
+        if self._is_deferred_fetch():
+            return self._gather_deferred(harvest_job, dataset_ids, queue)
+
+        discovery_errors = []
+        chunks = self._get_chunks(
+            dataset_ids,
+            int(config.get('ckanext.zhgis.csw_chunk_size', 20)),
+            discovery_errors
+        )
+        concurrency = int(config.get('ckanext.zhgis.gather_concurrency', 4))
+
+        # the ids may be discovered page by page while the worker threads
+        # already fetch and map the records of the first chunks,
+        # the harvest objects are only saved here in the main thread
+        unchanged = 0
+        pool = ThreadPool(max(1, concurrency))
+        try:
+            for results in pool.imap(self._fetch_datasets, chunks):
+                for dataset_id, metadata, fingerprint, error in results:
+                    if error is not None:
+                        self._save_gather_error(error, harvest_job)
+                        continue
+
+                    if previous_fingerprints.get(dataset_id) == fingerprint:
+                        log.debug('%s has not changed' % dataset_id)
+                        unchanged += 1
+                        continue
+
+                    obj = HarvestObject(
+                        guid=metadata['id'],
+                        job=harvest_job,
+                        content=json.dumps(metadata),
+                        extras=[
+                            HarvestObjectExtra(
+                                key='fingerprint',
+                                value=fingerprint
+                            )
+                        ]
+                    )
+                    obj.save()
+                    log.debug('adding ' + metadata['name'] + ' to the queue')
+                    queue.add(obj.id)
+        except:
+            # do not wait for the remaining chunks to be fetched
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            ids = queue.close()
+
+        for error in discovery_errors:
+            self._save_gather_error(error, harvest_job)
+
+        log.info(
+            '%s changed datasets added to the queue, %s unchanged'
+            % (len(queue), unchanged)
+        )
+        return ids
+
+    def _is_deferred_fetch(self):
+        return asbool(config.get('ckanext.zhgis.defer_fetch', False))
+
+    def _gather_deferred(self, harvest_job, dataset_ids, queue):
+        '''
+        Only saves the guid and the hardcoded values of every dataset,
+        the records are fetched and mapped in the fetch stage
+        '''
+        try:
+            for dataset_id in dataset_ids:
+                obj = HarvestObject(
+                    guid=dataset_id,
+                    job=harvest_job,
+                    content=json.dumps(self._get_dataset(dataset_id))
+                )
+                obj.save()
+                queue.add(obj.id)
+        except Exception, e:
+            log.exception(e)
+            self._save_gather_error(
+                'Error discovering datasets: %s' % e,
+                harvest_job
+            )
+        finally:
+            ids = queue.close()
+
+        log.info('%s datasets added to the queue' % len(queue))
+        return ids
+
+    def _get_previous_fingerprints(self, source_id):
+        '''
+        Returns the fingerprints of the current harvest objects
+        of the source by guid
+        '''
+        query = (
+            Session.query(HarvestObject.guid, HarvestObjectExtra.value)
+            .join(
+                HarvestObjectExtra,
+                HarvestObjectExtra.harvest_object_id == HarvestObject.id
+            )
+            .filter(HarvestObject.harvest_source_id == source_id)
+            .filter(HarvestObject.current == True)  # noqa
+            .filter(HarvestObjectExtra.key == 'fingerprint')
+        )
+        return dict(query.all())
+
+    def _is_forced_remap(self):
+        return asbool(config.get('ckanext.zhgis.force_remap', False))
+
+    def _get_fingerprint(self, csw, dataset_xml, dataset):
+        '''
+        Returns a fingerprint of the record, the mapping and the hardcoded
+        values of a dataset, it changes whenever one of them changes
+        '''
+        return '%s:%s' % (
+            hashlib.sha256(csw.get_fingerprint(dataset_xml)).hexdigest(),
+            self._get_mapping_digest(dataset)
+        )
+
+    def _get_mapping_digest(self, dataset):
+        '''
+        Returns a digest of the mapping version, the hardcoded values
+        added to every dataset and the ones of the given dataset
+        '''
+        return hashlib.sha256(json.dumps({
+            'version': self.MAPPING_VERSION,
+            'license': self.LICENSE,
+            'organization': self.ORGANIZATION,
+            'groups': self.GROUPS,
+            'dataset': dataset,
+        }, sort_keys=True)).hexdigest()
+
+    def _get_dataset(self, dataset_id):
+        '''
+        Returns the hardcoded values of a dataset, datasets discovered
+        in the CSW may have none
+        '''
+        return self.DATASETS.get(dataset_id, {})
+
+    def _get_chunks(self, dataset_ids, chunk_size, errors):
+        '''
+        Yields lists of chunk_size ids. This is consumed by the task
+        handler of the thread pool, which must not fail, so discovery
+        errors are appended to errors instead of being raised.
+        '''
+        chunk = []
+        try:
+            for dataset_id in dataset_ids:
+                chunk.append(dataset_id)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        except Exception, e:
+            log.exception(e)
+            errors.append('Error discovering datasets: %s' % e)
+        if chunk:
+            yield chunk
+
+    def _is_search_discovery(self):
+        discovery = config.get('ckanext.zhgis.discovery', 'datasets')
+        return discovery.strip().lower() == 'search'
+
+    def _get_all_dataset_ids(self):
+        '''
+        Returns the ids of all datasets, either the hardcoded ones or
+        an iterator over the ids of all CSW records matching
+        ckanext.zhgis.csw_constraints, page by page
+        '''
+        if not self._is_search_discovery():
+            return sorted(self.DATASETS)
+
+        csw = ckan_csw.ZhGisCkanMetadata()
+        return csw.iter_ids(
+            self._get_csw_constraints(),
+            self._get_csw_page_size()
+        )
+
+    def _get_csw_page_size(self):
+        return int(config.get('ckanext.zhgis.csw_page_size', 100))
+
+    def _get_dataset_ids(self, harvest_job, previous_fingerprints):
+        '''
+        Returns the ids of the datasets to fetch.
+        If the source has a finished job without errors, only the datasets
+        modified in the CSW since then, the datasets which failed in a
+        later job, the datasets with a changed mapping or hardcoded values
+        and the datasets without a current harvest object are fetched.
+        '''
+        if (not asbool(config.get('ckanext.zhgis.incremental_gather', True))
+                or self._is_forced_remap()):
+            return self._get_all_dataset_ids()
+
+        last_job = self._get_last_clean_job(harvest_job)
+        if last_job is None:
+            return self._get_all_dataset_ids()
+        failed_ids = self._get_failed_ids(harvest_job, last_job.created)
+
+        if self._is_search_discovery():
+            search_ids = None
+        else:
+            # only search the hardcoded datasets, not the whole catalog
+            search_ids = sorted(self.DATASETS)
+        try:
             csw = ckan_csw.ZhGisCkanMetadata()
-            metadata = csw.get_ckan_metadata_by_id(dataset_id).copy()
-            log.debug(metadata)
+            modified_ids = set(csw.get_modified_since(
+                last_job.created,
+                self._get_csw_constraints(),
+                self._get_csw_page_size(),
+                search_ids
+            ))
+            if self._is_search_discovery():
+                # records without a current object are not necessarily
+                # modified, e.g. if they failed before or newly match
+                # the constraints, so all matching ids are listed
+                discovered_ids = set(self._get_all_dataset_ids())
+        except Exception, e:
+            log.exception(e)
+            log.warning('Searching modified datasets failed, fetching all')
+            return self._get_all_dataset_ids()
 
-            # Fix metadata information
-            metadata['name'] = munge_title_to_name(metadata['name'])
-            metadata['service_type'] = (
-                metadata['service_type'].replace('OGC:', '')
+        def is_current(dataset_id):
+            fingerprint = previous_fingerprints.get(dataset_id)
+            return fingerprint is not None and fingerprint.endswith(
+                ':' + self._get_mapping_digest(self._get_dataset(dataset_id))
             )
 
-            # Enrich metadata with hardcoded values
-            metadata['url'] = dataset['geolion_url']
-            metadata['tags'].extend(dataset['tags'])
+        if self._is_search_discovery():
+            dataset_ids = sorted(modified_ids | failed_ids | discovered_ids)
+        else:
+            dataset_ids = sorted(self.DATASETS)
+        dataset_ids = [
+            dataset_id for dataset_id in dataset_ids
+            if dataset_id in modified_ids or dataset_id in failed_ids or
+            not is_current(dataset_id)
+        ]
+        log.info(
+            '%s datasets modified since %s'
+            % (len(dataset_ids), last_job.created)
+        )
+        return dataset_ids
 
-            metadata['translations'] = self._generate_term_translations()
-            log.debug("Translations: %s" % metadata['translations'])
+    def _get_last_clean_job(self, harvest_job):
+        '''
+        Returns the newest finished job of the source without gather and
+        object errors. A job is finished as well if fetching or importing
+        some of its datasets failed, their modifications would be missed
+        by searching from the time of such a job.
+        '''
+        gather_error_job_ids = (
+            Session.query(HarvestGatherError.harvest_job_id)
+            .subquery()
+        )
+        object_error_job_ids = (
+            Session.query(HarvestObject.harvest_job_id)
+            .join(
+                HarvestObjectError,
+                HarvestObjectError.harvest_object_id == HarvestObject.id
+            )
+            .filter(HarvestObject.harvest_source_id == harvest_job.source_id)
+            .subquery()
+        )
+        return (
+            Session.query(HarvestJob)
+            .filter(HarvestJob.source_id == harvest_job.source_id)
+            .filter(HarvestJob.id != harvest_job.id)
+            .filter(HarvestJob.status == u'Finished')
+            .filter(~HarvestJob.id.in_(gather_error_job_ids))
+            .filter(~HarvestJob.id.in_(object_error_job_ids))
+            .order_by(HarvestJob.created.desc())
+            .first()
+        )
 
-            metadata['resources'] = (
-                self._generate_resource_dict_array(metadata)
+    def _get_failed_ids(self, harvest_job, since):
+        '''
+        Returns the ids of the datasets with object errors in the jobs
+        of the source created after the given datetime
+        '''
+        query = (
+            Session.query(HarvestObject.guid)
+            .join(
+                HarvestObjectError,
+                HarvestObjectError.harvest_object_id == HarvestObject.id
             )
-            log.debug(metadata['resources'])
+            .join(HarvestJob, HarvestJob.id == HarvestObject.harvest_job_id)
+            .filter(HarvestObject.harvest_source_id == harvest_job.source_id)
+            .filter(HarvestJob.created > since)
+        )
+        return set(guid for guid, in query)
 
-            metadata['license_id'] = self.LICENSE['name']
-            metadata['license_url'] = self.LICENSE['url']
+    def _get_csw_constraints(self):
+        '''
+        Returns the constraints of ckanext.zhgis.csw_constraints as
+        (propertyname, value) tuples, the constraints are separated by
+        semicolons or newlines, e.g. "OrganisationName=GIS-ZH"
+        '''
+        constraints = []
+        setting = config.get('ckanext.zhgis.csw_constraints', '')
+        for constraint in setting.replace(';', '\n').splitlines():
+            if '=' in constraint:
+                propertyname, value = constraint.split('=', 1)
+                constraints.append((propertyname.strip(), value.strip()))
+        return constraints
 
-            obj = HarvestObject(
-                guid=metadata['id'],
-                job=harvest_job,
-                content=json.dumps(metadata)
+    def _fetch_datasets(self, dataset_ids):
+        '''
+        Fetches and maps the given datasets, this runs in a worker thread.
+        Returns a (dataset_id, metadata, fingerprint, error) tuple for
+        every given id in the same order.
+        '''
+        csw = ckan_csw.ZhGisCkanMetadata()
+        records = {}
+        try:
+            for dataset_id, dataset_xml in csw.get_by_ids(
+                    dataset_ids, len(dataset_ids)):
+                try:
+                    metadata, fingerprint = self._map_dataset(
+                        csw,
+                        dataset_xml,
+                        self._get_dataset(dataset_id)
+                    )
+                    records[dataset_id] = (metadata, fingerprint, None)
+                except Exception, e:
+                    log.exception(e)
+                    records[dataset_id] = (
+                        None,
+                        None,
+                        'Error mapping dataset %s: %s' % (dataset_id, e)
+                    )
+        except Exception, e:
+            log.exception(e)
+            return [
+                (dataset_id, None, None,
+                    'Error fetching dataset %s: %s' % (dataset_id, e))
+                for dataset_id in dataset_ids
+            ]
+
+        results = []
+        for dataset_id in dataset_ids:
+            metadata, fingerprint, error = records.get(
+                dataset_id,
+                (None, None, 'Dataset with id %s not found' % dataset_id)
             )
-            obj.save()
-            log.debug('adding ' + metadata['name'] + ' to the queue')
-            ids.append(obj.id)
+            results.append((dataset_id, metadata, fingerprint, error))
+        return results
 
-        return ids
+    def _map_dataset(self, csw, dataset_xml, dataset):
+        '''
+        Maps and enriches a record with the hardcoded values of the dataset,
+        returns the metadata and the fingerprint of the record
+        '''
+        metadata_by_lang = csw.get_ckan_metadata_multilang_by_xml(dataset_xml)
+        metadata = dict(metadata_by_lang[u'de'])
+        log.debug(metadata)
+        translations = self._generate_metadata_translations(metadata_by_lang)
+        self._enrich_metadata(metadata, dataset)
+        metadata['translations'].extend(translations)
+        store_metadata_raw(metadata)
+        return metadata, self._get_fingerprint(csw, dataset_xml, dataset)
+
+    def _enrich_metadata(self, metadata, dataset):
+        # Fix metadata information
+        metadata['name'] = munge_title_to_name(metadata['name'])
+        metadata['service_type'] = (
+            metadata['service_type'].replace('OGC:', '')
+        )
+
+        # Enrich metadata with hardcoded values
+        metadata['url'] = dataset.get('geolion_url', metadata['url'])
+        metadata['tags'].extend(dataset.get('tags', []))
+
+        # the translations of the groups and the organization
+        # are submitted once per job during import
+        metadata['translations'] = []
+
+        metadata['resources'] = (
+            self._generate_resource_dict_array(metadata)
+        )
+        log.debug(metadata['resources'])
+
+        metadata['license_id'] = self.LICENSE['name']
+        metadata['license_url'] = self.LICENSE['url']
 
     def fetch_stage(self, harvest_object):
         log.debug('In ZhGisHarvester fetch_stage')
+        if not self._is_deferred_fetch():
+            return True
+
+        dataset_id = harvest_object.guid
+        csw = ckan_csw.ZhGisCkanMetadata()
+        try:
+            metadata, fingerprint = self._map_dataset(
+                csw,
+                csw.get_record(dataset_id),
+                json.loads(harvest_object.content)
+            )
+        except Exception, e:
+            log.exception(e)
+            self._save_object_error(
+                'Error fetching dataset %s: %s' % (dataset_id, e),
+                harvest_object,
+                'Fetch'
+            )
+            return False
+
+        # an unchanged record is imported as well, the import
+        # skips its package by the content hash
+        harvest_object.content = json.dumps(metadata)
+        harvest_object.extras.append(
+            HarvestObjectExtra(key='fingerprint', value=fingerprint)
+        )
+        harvest_object.save()
         return True
 
     def import_stage(self, harvest_object):
@@ -486,21 +913,18 @@ class ZhGisHarvester(HarvesterBase):
             package_dict = json.loads(harvest_object.content)
 
             package_dict['id'] = harvest_object.guid
-            user = model.User.get(self.HARVEST_USER)
             context = {
                 'model': model,
                 'session': Session,
-                'user': self.HARVEST_USER
+                'user': self.HARVEST_USER,
+                'defer_commit': self.defer_commit
                 }
+            resolved_ids = self._get_resolved_ids(harvest_object, context)
 
-            # Find or create group the dataset should get assigned to
-            package_dict['groups'] = self._find_or_create_groups(context)
-
-            # Find or create the organization
-            # the dataset should get assigned to
-            package_dict['owner_org'] = self._find_or_create_organization(
-                context
-            )
+            # The group and the organization the dataset
+            # should get assigned to
+            package_dict['groups'] = list(resolved_ids['groups'])
+            package_dict['owner_org'] = resolved_ids['owner_org']
 
             # Save license url in extras
             extras = []
@@ -508,28 +932,223 @@ class ZhGisHarvester(HarvesterBase):
                 extras.append(('license_url', package_dict['license_url']))
             package_dict['extras'] = extras
 
-            package = model.Package.get(package_dict['id'])
-            model.PackageRole(
-                package=package,
-                user=user,
-                role=model.Role.ADMIN
-            )
+            # Save a hash of the package to detect unchanged packages
+            content_hash = self._get_content_hash(package_dict)
+            extras.append((self.CONTENT_HASH_KEY, content_hash))
 
-            log.debug(
-                'Save or update package %s (%s)'
-                % (package_dict['name'], package_dict['id'])
-            )
-            self._create_or_update_package(package_dict, harvest_object)
+            package = self._get_package(package_dict['id'])
+            user_id = resolved_ids['user_id']
+            if (package is not None and user_id is not None and
+                    not self._is_package_admin(package, user_id)):
+                model.PackageRole(
+                    package=package,
+                    user_id=user_id,
+                    role=model.Role.ADMIN
+                )
+
+            if (package is not None and not self.force_import and
+                    package.state == u'active' and
+                    package.extras.get(self.CONTENT_HASH_KEY) == content_hash):
+                log.debug(
+                    'Package %s (%s) has not changed'
+                    % (package_dict['name'], package_dict['id'])
+                )
+                self._flag_current(package.id, harvest_object)
+                import_action = 'skipped'
+            else:
+                log.debug(
+                    'Save or update package %s (%s)'
+                    % (package_dict['name'], package_dict['id'])
+                )
+                try:
+                    self._save_package(package_dict, package, harvest_object)
+                except Exception, e:
+                    if self.defer_commit:
+                        raise
+                    # save it as an object error like HarvesterBase does
+                    log.exception(e)
+                    Session.rollback()
+                    if isinstance(e, ValidationError):
+                        message = 'Invalid package with GUID %s: %r' % (
+                            harvest_object.guid,
+                            e.error_dict
+                        )
+                    else:
+                        message = '%r' % e
+                    self._save_object_error(message, harvest_object, 'Import')
+                    self._resolved_ids = None
+                    return False
+                import_action = 'created' if package is None else 'updated'
 
             log.debug('Save or update term translations')
-            self._submit_term_translations(context, package_dict)
-            Session.commit()
+            self._submit_term_translations(
+                context,
+                package_dict['translations']
+            )
+            if not self.defer_commit:
+                Session.commit()
 
         except Exception, e:
             log.exception(e)
+            # the cached ids may be the cause, e.g. a deleted group
+            self._resolved_ids = None
             raise
+
+        if self._packages is not None:
+            # the package may have been created
+            self._packages.pop(package_dict['id'], None)
+        self._count_import(harvest_object, import_action)
         return True
 
+    def prefetch_packages(self, guids):
+        '''
+        Loads the packages of the given guids with their extras and
+        resources in one query, import_stage then uses them instead of
+        looking up every package on its own. This is only useful within
+        one transaction, a commit expires all loaded packages.
+        '''
+        if not guids:
+            self._packages = None
+            return
+
+        query = (
+            Session.query(model.Package)
+            .filter(model.Package.id.in_(guids))
+            .options(subqueryload(model.Package._extras))
+        )
+        if hasattr(model.Package, 'resources_all'):
+            query = query.options(subqueryload(model.Package.resources_all))
+        else:
+            query = query.options(
+                subqueryload_all('resource_groups_all.resources_all')
+            )
+        packages = dict((guid, None) for guid in guids)
+        packages.update((package.id, package) for package in query)
+        self._packages = packages
+
+    def _get_package(self, package_id):
+        if self._packages is not None and package_id in self._packages:
+            return self._packages[package_id]
+        return model.Package.get(package_id)
+
+    def _get_content_hash(self, package_dict):
+        '''
+        Returns a hash of the package_dict without the translations,
+        which are saved separately. The tags are sorted, so only
+        changed values change the hash.
+        '''
+        content = dict(package_dict)
+        content.pop('translations', None)
+        content['tags'] = sorted(set(content.get('tags', [])))
+        return hashlib.sha256(json.dumps(content, sort_keys=True)).hexdigest()
+
+    def _count_import(self, harvest_object, import_action):
+        job_id = harvest_object.harvest_job_id
+        if self.import_stats is None or self.import_stats['job_id'] != job_id:
+            self.import_stats = {
+                'job_id': job_id,
+                'created': 0,
+                'updated': 0,
+                'skipped': 0,
+            }
+        self.import_stats[import_action] += 1
+        self.last_import_action = import_action
+        log.info(
+            'Package %s %s, job %s: %s created, %s updated, %s skipped'
+            % (
+                harvest_object.guid,
+                import_action,
+                job_id,
+                self.import_stats['created'],
+                self.import_stats['updated'],
+                self.import_stats['skipped'],
+            )
+        )
+
+    def _flag_current(self, package_id, harvest_object):
+        '''
+        Flags the harvest object as the current one of the package
+        '''
+        (
+            Session.query(HarvestObject)
+            .filter(HarvestObject.package_id == package_id)
+            .filter(HarvestObject.id != harvest_object.id)
+            .update({'current': False}, synchronize_session=False)
+        )
+        harvest_object.package_id = package_id
+        harvest_object.current = True
+        Session.add(harvest_object)
+        Session.flush()
+
+    def _save_package(self, package_dict, package, harvest_object):
+        '''
+        Creates or updates the package and flags the harvest object as the
+        current one. Used instead of _create_or_update_package by the queue
+        and the batch import, it only flushes the changes and raises errors.
+        '''
+        schema = default_create_package_schema()
+        schema['id'] = [ignore_missing, unicode]
+        schema['__junk'] = [ignore]
+        context = {
+            'model': model,
+            'session': Session,
+            'user': self.HARVEST_USER,
+            'api_version': 2,
+            'schema': schema,
+            'ignore_auth': True,
+            'defer_commit': True,
+        }
+        package_dict['tags'] = list(set(
+            munge_tag(tag) for tag in package_dict.get('tags', [])
+        ))
+
+        if package is None:
+            log.info('Creating package with GUID %s' % harvest_object.guid)
+            get_action('package_create_rest')(context, package_dict)
+        else:
+            log.info('Updating package with GUID %s' % harvest_object.guid)
+            context['id'] = package_dict['id']
+            get_action('package_update_rest')(context, package_dict)
+
+        self._flag_current(package_dict['id'], harvest_object)
+
+    def _get_resolved_ids(self, harvest_object, context):
+        '''
+        Returns the ids of the harvest user, the groups and the organization.
+        They are only looked up or created once per job and process, or
+        once per source in the reimports, which import the objects of many
+        jobs one after the other. The translations of the groups and the
+        organization are submitted at the same time.
+        '''
+        if self.defer_commit or self.force_import:
+            key = harvest_object.harvest_source_id
+        else:
+            key = harvest_object.harvest_job_id
+        if self._resolved_ids is None or self._resolved_ids['key'] != key:
+            user = model.User.get(self.HARVEST_USER)
+            resolved_ids = {
+                'key': key,
+                'user_id': user.id if user is not None else None,
+                'groups': self._find_or_create_groups(context),
+                'owner_org': self._find_or_create_organization(context),
+            }
+            self._submit_term_translations(
+                context,
+                self._generate_term_translations()
+            )
+            self._resolved_ids = resolved_ids
+        return self._resolved_ids
+
+    def _is_package_admin(self, package, user_id):
+        role = (
+            Session.query(model.PackageRole.id)
+            .filter(model.PackageRole.package_id == package.id)
+            .filter(model.PackageRole.user_id == user_id)
+            .filter(model.PackageRole.role == model.Role.ADMIN)
+            .first()
+        )
+        return role is not None
+
     def _find_or_create_groups(self, context):
         group_name = self.GROUPS['de'][0]
         data_dict = {
@@ -539,7 +1158,7 @@ class ZhGisHarvester(HarvesterBase):
             }
         try:
             group = get_action('group_show')(context, data_dict)
-        except:
+        except NotFound:
             group = get_action('group_create')(context, data_dict)
             log.info('created the group ' + group['id'])
         group_ids = []
@@ -562,7 +1181,7 @@ class ZhGisHarvester(HarvesterBase):
                 ]
             }
             organization = get_action('organization_show')(context, data_dict)
-        except:
+        except NotFound:
             organization = get_action('organization_create')(
                 context,
                 data_dict
@@ -600,10 +1219,75 @@ class ZhGisHarvester(HarvesterBase):
             log.exception(e)
             raise
 
-    def _submit_term_translations(self, context, package_dict):
-        for translation in package_dict['translations']:
-            log.debug(translation)
-            action.update.term_translation_update(context, translation)
+    def _generate_metadata_translations(self, metadata_by_lang):
+        '''
+        Generate term translations for the title and notes of a dataset
+        '''
+        translations = []
+        for lang, metadata in metadata_by_lang.iteritems():
+            if lang == u'de':
+                continue
+            for field in ['title', 'notes']:
+                term = metadata_by_lang[u'de'][field]
+                term_translation = metadata[field]
+                if term and term_translation and term_translation != term:
+                    translations.append({
+                        'lang_code': lang,
+                        'term': term,
+                        'term_translation': term_translation
+                    })
+        return translations
+
+    def _submit_term_translations(self, context, translations):
+        '''
+        Saves the given translations with a single update call unless the
+        commit is deferred, translations already saved are skipped
+        '''
+        translations = self._get_changed_translations(translations)
+        if not translations:
+            return
+        log.debug(translations)
+        if context.get('defer_commit'):
+            # term_translation_update_many always commits
+            for translation in translations:
+                action.update.term_translation_update(
+                    dict(context),
+                    translation
+                )
+        else:
+            action.update.term_translation_update_many(
+                dict(context),
+                {'data': translations}
+            )
+
+    def _get_changed_translations(self, translations):
+        '''
+        Returns the given translations without duplicates and without the
+        translations which are already saved in the term_translation table
+        '''
+        unique_translations = {}
+        for translation in translations:
+            key = (translation['term'], translation['lang_code'])
+            unique_translations[key] = translation
+        if not unique_translations:
+            return []
+
+        table = model.term_translation_table
+        terms = set(term for term, lang_code in unique_translations)
+        query = (
+            Session.query(
+                table.c.term,
+                table.c.lang_code,
+                table.c.term_translation
+            )
+            .filter(table.c.term.in_(terms))
+        )
+        for term, lang_code, term_translation in query:
+            translation = unique_translations.get((term, lang_code))
+            if (translation is not None and
+                    translation['term_translation'] == term_translation):
+                del unique_translations[(term, lang_code)]
+        return unique_translations.values()
 
     def _generate_resource_dict_array(self, metadata):
         resources = [{
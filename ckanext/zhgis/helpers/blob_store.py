@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+
+from pylons import config
+
+from ckanext.zhgis.helpers import s3
+import logging
+log = logging.getLogger(__name__)
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_blob_store():
+    """
+        Returns the process-wide blob store configured with
+        ckanext.zhgis.blob_store ('local' or 's3') or None if not set
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            store_type = config.get('ckanext.zhgis.blob_store', '').strip()
+            if store_type == 'local':
+                _store = LocalBlobStore(
+                    config['ckanext.zhgis.blob_store_dir']
+                )
+            elif store_type == 's3':
+                _store = S3BlobStore(
+                    s3.S3(),
+                    config.get('ckanext.zhgis.blob_store_prefix', 'blobs/')
+                )
+            elif store_type:
+                raise ValueError("Unknown blob store '%s'" % store_type)
+    return _store
+
+
+def store_metadata_raw(metadata):
+    """
+        Moves the metadata_raw of the metadata to the blob store and
+        replaces it with its metadata_raw_digest
+    """
+    store = get_blob_store()
+    if store is None or metadata.get('metadata_raw') is None:
+        return
+    metadata['metadata_raw_digest'] = store.put(metadata.pop('metadata_raw'))
+
+
+def resolve_metadata_raw(metadata):
+    """
+        Adds the metadata_raw of the metadata_raw_digest of the metadata
+        if it has not been resolved yet. Only needed to read the raw XML,
+        the packages do not contain it.
+    """
+    digest = metadata.get('metadata_raw_digest')
+    if digest is None or 'metadata_raw' in metadata:
+        return
+    store = get_blob_store()
+    if store is None:
+        raise BlobNotFoundError(
+            "No blob store configured to resolve %s" % digest
+        )
+    metadata['metadata_raw'] = store.get(digest)
+
+
+class BlobStore(object):
+    """
+        Content-addressed store of zlib compressed blobs,
+        every blob is stored once by the SHA-256 digest of its content
+    """
+    def put(self, data):
+        """ Stores the data if it is not stored yet, returns its digest """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.exists(digest):
+            self.write(digest, zlib.compress(data))
+            log.debug("Stored blob %s" % digest)
+        return digest
+
+    def get(self, digest):
+        """ Returns the data with the given digest """
+        return zlib.decompress(self.read(digest))
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def read(self, digest):
+        raise NotImplementedError
+
+    def write(self, digest, compressed):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """ Stores the blobs in a local directory """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __repr__(self):
+        return "<LocalBlobStore directory:%s>" % self.directory
+
+    def get_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.get_path(digest))
+
+    def read(self, digest):
+        try:
+            with open(self.get_path(digest), 'rb') as blob_file:
+                return blob_file.read()
+        except IOError:
+            raise BlobNotFoundError("Blob %s not found" % digest)
+
+    def write(self, digest, compressed):
+        path = self.get_path(digest)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=directory)
+        with os.fdopen(fd, 'wb') as blob_file:
+            blob_file.write(compressed)
+        os.rename(tmp_path, path)
+
+
+class S3BlobStore(BlobStore):
+    """
+        Stores the blobs in the S3 bucket of the S3 helper.
+        Every thread keeps its own connection to the bucket, the bucket
+        is not validated, so every operation is a single request.
+    """
+    def __init__(self, s3_helper, prefix='blobs/'):
+        self.s3_helper = s3_helper
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def __repr__(self):
+        return (
+            "<S3BlobStore bucket_name:%s prefix:%s>"
+            % (self.s3_helper.bucket_name, self.prefix)
+        )
+
+    def get_bucket(self):
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            bucket = self.s3_helper.get_bucket(validate=False)
+            self._local.bucket = bucket
+        return bucket
+
+    def exists(self, digest):
+        bucket = self.get_bucket()
+        return bucket.get_key(self.prefix + digest) is not None
+
+    def read(self, digest):
+        bucket = self.get_bucket()
+        key = bucket.get_key(self.prefix + digest)
+        if key is None:
+            raise BlobNotFoundError("Blob %s not found" % digest)
+        return key.get_contents_as_string()
+
+    def write(self, digest, compressed):
+        bucket = self.get_bucket()
+        key = bucket.new_key(self.prefix + digest)
+        key.set_contents_from_string(compressed)
+
+
+class BlobNotFoundError(Exception):
+    pass
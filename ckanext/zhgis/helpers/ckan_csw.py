@@ -1,10 +1,25 @@
 # -*- coding: utf-8 -*-
 
-from owslib.csw import CatalogueServiceWeb
+from StringIO import StringIO
+import threading
+
+from owslib.csw import CatalogueServiceWeb, schema_location
+from owslib import ows, util
 from lxml import etree
+from pylons import config
+import requests
+from requests.adapters import HTTPAdapter
+import collections
+import copy
+import hashlib
+
+from ckanext.zhgis.helpers import csw_cache
+
 import logging
 log = logging.getLogger(__name__)
 
+LANGUAGES = ('de', 'fr', 'it', 'en')
+
 namespaces = {
     'atom': 'http://www.w3.org/2005/Atom',
     'che': 'http://www.geocat.ch/2008/che',
@@ -27,43 +42,454 @@ namespaces = {
 }
 
 
+def get_condition(operator, propertyname, literal):
+    """ Returns an OGC filter condition like PropertyIsEqualTo """
+    condition = etree.Element('{%s}%s' % (namespaces['ogc'], operator))
+    etree.SubElement(
+        condition,
+        '{%s}PropertyName' % namespaces['ogc']
+    ).text = propertyname
+    etree.SubElement(
+        condition,
+        '{%s}Literal' % namespaces['ogc']
+    ).text = literal
+    return condition
+
+
+def get_conditions(constraints=None):
+    """
+        Returns PropertyIsEqualTo conditions for a list
+        of (propertyname, value) tuples
+    """
+    return [
+        get_condition('PropertyIsEqualTo', propertyname, value)
+        for propertyname, value in constraints or []
+    ]
+
+
+def get_any_condition(conditions):
+    """ Returns an ogc:Or of the given conditions or the only one """
+    if len(conditions) == 1:
+        return conditions[0]
+    any_condition = etree.Element('{%s}Or' % namespaces['ogc'])
+    for condition in conditions:
+        any_condition.append(condition)
+    return any_condition
+
+
+def get_records_request(conditions, start_position=1, max_records=100):
+    """
+        Returns a GetRecords request for the brief records
+        matching all given OGC filter conditions
+    """
+    csw = namespaces['csw']
+    ogc = namespaces['ogc']
+    request = etree.Element(
+        '{%s}GetRecords' % csw,
+        nsmap={'csw': csw, 'ogc': ogc}
+    )
+    request.set('service', 'CSW')
+    request.set('version', '2.0.2')
+    request.set('resultType', 'results')
+    request.set('outputSchema', csw)
+    request.set('startPosition', str(start_position))
+    request.set('maxRecords', str(max_records))
+
+    query = etree.SubElement(request, '{%s}Query' % csw)
+    query.set('typeNames', 'csw:Record')
+    etree.SubElement(query, '{%s}ElementSetName' % csw).text = 'brief'
+    if conditions:
+        constraint = etree.SubElement(query, '{%s}Constraint' % csw)
+        constraint.set('version', '1.1.0')
+        ogc_filter = etree.SubElement(constraint, '{%s}Filter' % ogc)
+        if len(conditions) > 1:
+            ogc_filter = etree.SubElement(ogc_filter, '{%s}And' % ogc)
+        for condition in conditions:
+            ogc_filter.append(condition)
+    return etree.tostring(request)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+        Returns the process-wide HTTP session used for all CSW requests.
+        The session keeps the connections alive, the size of its
+        connection pool is set with ckanext.zhgis.csw_pool_size.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = int(config.get('ckanext.zhgis.csw_pool_size', 10))
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def get_catalog(url, lang='en-US', version='2.0.2', timeout=10):
+    """ Returns a CSW client using the shared HTTP session """
+    return PooledCatalogueServiceWeb(
+        url,
+        lang,
+        version,
+        timeout=timeout,
+        skip_caps=True,
+        session=get_session()
+    )
+
+
+class PooledCatalogueServiceWeb(CatalogueServiceWeb):
+    """ CatalogueServiceWeb sending its requests with a shared session """
+    def __init__(self, url, lang='en-US', version='2.0.2', timeout=10,
+                 skip_caps=False, session=None):
+        self.session = session or get_session()
+        CatalogueServiceWeb.__init__(
+            self,
+            url,
+            lang,
+            version,
+            timeout=timeout,
+            skip_caps=skip_caps
+        )
+
+    def _invoke(self):
+        cache = csw_cache.get_cache()
+        response = None
+        if cache is not None:
+            response = cache.get(self.url, self.request)
+            if response is None and cache.offline:
+                raise csw_cache.CacheMissError(
+                    "No cached response for request to %s" % self.url
+                )
+
+        if response is None:
+            http_response = self._post()
+            self._parse_response(http_response.content)
+            if cache is not None:
+                cache.set(self.url, self.request, self.response)
+        else:
+            self._parse_response(response)
+
+    def _post(self, stream=False):
+        http_response = self.session.post(
+            self.url,
+            data=self.request,
+            headers={
+                'Content-type': 'text/xml',
+                'Accept': 'text/xml',
+                'Accept-Language': self.lang,
+            },
+            timeout=self.timeout,
+            stream=stream
+        )
+        http_response.raise_for_status()
+        return http_response
+
+    def _open_response(self):
+        """
+            Returns the body of the response to the current request
+            as a file-like object, without reading it into memory
+        """
+        cache = csw_cache.get_cache()
+        if cache is not None:
+            response = cache.open(self.url, self.request)
+            if response is not None:
+                return response
+            if cache.offline:
+                raise csw_cache.CacheMissError(
+                    "No cached response for request to %s" % self.url
+                )
+
+        http_response = self._post(stream=True)
+        if cache is None:
+            return ResponseStream(http_response)
+        return cache.set_stream(
+            self.url,
+            self.request,
+            http_response.iter_content(ResponseStream.chunk_size)
+        )
+
+    def iter_records_by_id(self, id=[], esn='full',
+                           outputschema=namespaces['csw']):
+        """
+            Sends a GetRecordById request and yields the records of the
+            response while it is parsed, so only one record is held in
+            memory. A record is cleared as soon as the next one is
+            requested, so it has to be processed before.
+        """
+        node0 = self._setrootelement('csw:GetRecordById')
+        node0.set('outputSchema', outputschema)
+        node0.set('outputFormat', 'application/xml')
+        node0.set('version', self.version)
+        node0.set('service', self.service)
+        node0.set(
+            util.nspath_eval('xsi:schemaLocation', namespaces),
+            schema_location
+        )
+        for i in id:
+            etree.SubElement(
+                node0,
+                util.nspath_eval('csw:Id', namespaces)
+            ).text = i
+        etree.SubElement(
+            node0,
+            util.nspath_eval('csw:ElementSetName', namespaces)
+        ).text = esn
+        self.request = util.xml2string(etree.tostring(node0))
+
+        response = self._open_response()
+        try:
+            for record_xml in self._iter_records(response):
+                yield record_xml
+        except (ows.ExceptionReport, RuntimeError, etree.XMLSyntaxError):
+            # the response is cached before it is parsed
+            cache = csw_cache.get_cache()
+            if cache is not None:
+                cache.delete(self.url, self.request)
+            raise
+        finally:
+            response.close()
+
+    def _iter_records(self, response):
+        """ Yields the children of the root element of the response """
+        exception_report = '{%s}ExceptionReport' % namespaces['ows']
+        root = None
+        for event, element in etree.iterparse(response,
+                                              events=('start', 'end')):
+            if root is None:
+                root = element
+                if not (root.tag.startswith('{%s}' % namespaces['csw']) or
+                        root.tag.startswith('{%s}' % namespaces['ows'])):
+                    raise RuntimeError('Document is XML, but not CSW-ish')
+            if (event != 'end' or element.getparent() is not root or
+                    root.tag == exception_report):
+                continue
+
+            yield element
+
+            # free the processed records, the tree only ever
+            # holds the root and the record being parsed
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+
+        if root is not None and root.tag == exception_report:
+            raise ows.ExceptionReport(root, self.owscommon.namespace)
+
+    def _parse_response(self, response):
+        self.response = response
+        self._exml = etree.parse(StringIO(self.response))
+        root_tag = self._exml.getroot().tag
+        if not (root_tag.startswith('{%s}' % namespaces['csw']) or
+                root_tag.startswith('{%s}' % namespaces['ows'])):
+            raise RuntimeError('Document is XML, but not CSW-ish')
+
+        exception = self._exml.find('{%s}Exception' % namespaces['ows'])
+        if exception is not None:
+            raise ows.ExceptionReport(self._exml, self.owscommon.namespace)
+        self.exceptionreport = None
+
+
+class ResponseStream(object):
+    """ File-like object reading the body of a streamed HTTP response """
+    chunk_size = 64 * 1024
+
+    def __init__(self, http_response):
+        self.http_response = http_response
+        self._chunks = http_response.iter_content(self.chunk_size)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self.http_response.raw.close()
+
+
 class Attribute(object):
-    def __init__(self, config, **kwargs):
+    """
+        Maps a CSW attribute to a CKAN attribute.
+        Attributes are shared by all records and threads, get_value must
+        only depend on its arguments and the configuration given
+        to the constructor and return a new value on every call.
+    """
+    def __init__(self, config, **options):
         self._config = config
-        self.env = kwargs
+        self.options = options
 
-    def get_value(self, **kwargs):
+    def get_option(self, name, options, default=None):
+        """ Returns an option of the call or of the constructor """
+        if name in options:
+            return options[name]
+        return self.options.get(name, default)
+
+    def get_value(self, xml, lang, **options):
         """ Abstract method to return the value of the attribute """
         raise NotImplementedError
 
+    def compile(self, lang):
+        """ Prepares the attribute to be evaluated in the given language """
+        pass
+
+    def clear(self):
+        """ Drops everything prepared by compile """
+        pass
+
+    def is_localized(self):
+        """ Returns True if the value depends on the language """
+        return False
+
+
+class CompositeAttribute(Attribute):
+    """ Attribute combining the values of a list of attributes """
+    def compile(self, lang):
+        for attribute in self._config:
+            attribute.compile(lang)
+
+    def clear(self):
+        for attribute in self._config:
+            attribute.clear()
+
+    def is_localized(self):
+        return any(attribute.is_localized() for attribute in self._config)
+
 
 class StringAttribute(Attribute):
-    def get_value(self, **kwargs):
+    def get_value(self, xml, lang, **options):
         return self._config
 
 
 class XmlAttribute(Attribute):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        xml = self.env['xml']
+    def get_value(self, xml, lang, **options):
         return etree.tostring(xml)
 
 
-class XPathAttribute(Attribute):
-    def get_element(self, xml, xpath):
-        return xml.xpath(xpath, namespaces=namespaces)[0]
+def split_xpath(expression):
+    """
+        Splits an XPath starting with a descendant step like
+        './/gmd:identificationInfo//gmd:citation' into the anchor
+        './/gmd:identificationInfo' and the tail './/gmd:citation'
+        relative to the anchor nodes.
+        Returns (None, expression) if the XPath can not be split.
+    """
+    if not expression.startswith('.//') or '|' in expression:
+        return None, expression
+    end = expression.find('/', 3)
+    if end == -1 or '[' in expression[3:end]:
+        return None, expression
+    return expression[:end], '.' + expression[end:]
+
+
+class AnchorCache(object):
+    """
+        Resolves the anchor nodes of the XPaths for one record,
+        each anchor is only searched once per record.
+    """
+    _xpaths = {}
+
+    def __init__(self, xml):
+        self.xml = xml
+        self._nodes = {}
+
+    def get_nodes(self, anchor):
+        try:
+            return self._nodes[anchor]
+        except KeyError:
+            try:
+                xpath = self._xpaths[anchor]
+            except KeyError:
+                xpath = etree.XPath(anchor, namespaces=namespaces)
+                self._xpaths[anchor] = xpath
+            nodes = xpath(self.xml)
+            self._nodes[anchor] = nodes
+            return nodes
 
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        xml = self.env['xml']
 
-        lang = self.env['lang']
-        xpath = self._config.replace('#DE', '#' + lang.upper())
-        log.debug("Lang: %s, XPath: %s" % (lang, xpath))
+class XPathAttribute(Attribute):
+    # set to False by 'paster zhgis benchmark' to measure the evaluation
+    # without the compiled XPaths and the anchors
+    compiled = True
+
+    def __init__(self, config, **options):
+        super(XPathAttribute, self).__init__(config, **options)
+        self._anchor, self._tail = split_xpath(config)
+        self._xpaths = {}
 
+    def compile(self, lang):
+        """
+            Returns the XPath compiled for the given language and
+            its tail relative to the anchor (None if there is no anchor)
+        """
+        try:
+            return self._xpaths[lang]
+        except KeyError:
+            expression = self._config.replace('#DE', '#' + lang.upper())
+            log.debug("Lang: %s, XPath: %s" % (lang, expression))
+            xpath = etree.XPath(expression, namespaces=namespaces)
+            tail_xpath = None
+            if self._anchor is not None:
+                tail_xpath = etree.XPath(
+                    self._tail.replace('#DE', '#' + lang.upper()),
+                    namespaces=namespaces
+                )
+            self._xpaths[lang] = (xpath, tail_xpath)
+            return self._xpaths[lang]
+
+    def clear(self):
+        self._xpaths = {}
+
+    def is_localized(self):
+        return '#DE' in self._config
+
+    def evaluate(self, xml, lang, anchors=None):
+        """ Returns all results of the XPath for the given language """
+        if not self.compiled:
+            expression = self._config.replace('#DE', '#' + lang.upper())
+            return xml.xpath(expression, namespaces=namespaces)
+
+        xpath, tail_xpath = self.compile(lang)
+        if anchors is None or tail_xpath is None:
+            return xpath(xml)
+
+        anchor_nodes = anchors.get_nodes(self._anchor)
+        if len(anchor_nodes) == 1:
+            return tail_xpath(anchor_nodes[0])
+        results = []
+        seen = set()
+        for node in anchor_nodes:
+            for result in tail_xpath(node):
+                # nested anchors return the same elements more than once
+                if isinstance(result, etree._Element):
+                    if result in seen:
+                        continue
+                    seen.add(result)
+                results.append(result)
+        return results
+
+    def get_element(self, xml, lang, anchors=None):
+        return self.evaluate(xml, lang, anchors)[0]
+
+    def get_value(self, xml, lang, **options):
         try:
             # this should probably return a XPathTextAttribute
-            value = self.get_element(xml, xpath)
+            value = self.get_element(xml, lang, options.get('anchors'))
         except Exception as e:
             log.exception(e)
             value = ''
@@ -71,47 +497,47 @@ class XPathAttribute(Attribute):
 
 
 class XPathMultiAttribute(XPathAttribute):
-    def get_element(self, xml, xpath):
-        return xml.xpath(xpath, namespaces=namespaces)
+    def get_element(self, xml, lang, anchors=None):
+        return self.evaluate(xml, lang, anchors)
 
 
 class XPathTextAttribute(XPathAttribute):
-    def get_value(self, **kwargs):
-        value = super(XPathTextAttribute, self).get_value(**kwargs)
+    def get_value(self, xml, lang, **options):
+        value = super(XPathTextAttribute, self).get_value(
+            xml,
+            lang,
+            **options
+        )
         return value.text if hasattr(value, 'text') else value
 
 
 class XPathMultiTextAttribute(XPathMultiAttribute):
-    def get_value(self, **kwargs):
-        value = super(XPathMultiTextAttribute, self).get_value(**kwargs)
+    def get_value(self, xml, lang, **options):
+        value = super(XPathMultiTextAttribute, self).get_value(
+            xml,
+            lang,
+            **options
+        )
         return value.text if hasattr(value, 'text') else value
 
 
-class CombinedAttribute(Attribute):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
+class CombinedAttribute(CompositeAttribute):
+    def get_value(self, xml, lang, **options):
+        separator = self.get_option('separator', options, ' ')
         value = ''
-        if 'separator' in self.env:
-            separator = self.env['separator']
-        else:
-            separator = ' '
         for attribute in self._config:
-            new_value = attribute.get_value(**kwargs)
+            new_value = attribute.get_value(xml, lang, **options)
             if new_value is not None:
-                value = value + attribute.get_value(**kwargs) + separator
+                value = value + new_value + separator
         return value.strip(separator)
 
 
-class MultiAttribute(Attribute):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
+class MultiAttribute(CompositeAttribute):
+    def get_value(self, xml, lang, **options):
+        separator = self.get_option('separator', options, ' ')
         value = ''
-        if 'separator' in self.env:
-            separator = self.env['separator']
-        else:
-            separator = ' '
         for attribute in self._config:
-            new_value = attribute.get_value(**kwargs)
+            new_value = attribute.get_value(xml, lang, **options)
             try:
                 iterator = iter(new_value)
                 for inner_attribute in iterator:
@@ -126,18 +552,18 @@ class MultiAttribute(Attribute):
         return value.strip(separator)
 
 
-class ArrayAttribute(Attribute):
+class ArrayAttribute(CompositeAttribute):
+    @staticmethod
     def _isstr(s):
         try:
             return isinstance(s, basestring)
         except NameError:
             return isinstance(s, str)
 
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
+    def get_value(self, xml, lang, **options):
         value = []
         for attribute in self._config:
-            new_value = attribute.get_value(**kwargs)
+            new_value = attribute.get_value(xml, lang, **options)
             try:
                 if self._isstr(new_value):
                     raise TypeError
@@ -155,26 +581,105 @@ class ArrayAttribute(Attribute):
 
 
 class FirstInOrderAttribute(CombinedAttribute):
-    def get_value(self, **kwargs):
+    def get_value(self, xml, lang, **options):
         for attribute in self._config:
-            value = attribute.get_value(**kwargs)
+            value = attribute.get_value(xml, lang, **options)
             if value != '':
                 return value
         return ''
 
 
+class MappingEngine(object):
+    """
+        Evaluates a mapping of CKAN attributes to CSW attributes.
+        The XPath expressions of the mapping are compiled once per
+        language and kept on the attributes for all later records.
+    """
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def compile(self, lang):
+        for attribute in self.mapping.values():
+            attribute.compile(lang)
+
+    def clear(self):
+        for attribute in self.mapping.values():
+            attribute.clear()
+
+    def get_value(self, key, xml, lang, anchors=None, shared=None):
+        """
+            Returns the value of the given key.
+            Values not depending on the language are kept in the
+            optional shared dict, so they are only evaluated once
+            for all languages of a record.
+        """
+        log.debug("Metadata key: %s" % key)
+        attribute = self.mapping[key]
+        if shared is None or attribute.is_localized():
+            return attribute.get_value(xml, lang, anchors=anchors)
+        if key not in shared:
+            shared[key] = attribute.get_value(xml, lang, anchors=anchors)
+        return copy.copy(shared[key])
+
+
+class LazyMetadata(collections.MutableMapping):
+    """
+        CKAN metadata of one record.
+        The value of a key is only evaluated on the first access,
+        keys can be set or deleted without evaluating them.
+    """
+    def __init__(self, engine, xml, lang, keys, anchors=None, shared=None):
+        self._engine = engine
+        self._xml = xml
+        self._lang = lang
+        self._keys = list(keys)
+        self._anchors = anchors if anchors is not None else AnchorCache(xml)
+        self._shared = shared
+        self._values = {}
+        engine.compile(lang)
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._keys:
+                raise KeyError(key)
+            self._values[key] = self._engine.get_value(
+                key,
+                self._xml,
+                self._lang,
+                self._anchors,
+                self._shared
+            )
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            self._keys.append(key)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        self._keys.remove(key)
+        self._values.pop(key, None)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '<LazyMetadata lang:%s keys:%s evaluated:%s>' % (
+            self._lang, self._keys, sorted(self._values)
+        )
+
+
 class CkanMetadata(object):
     """ Provides general access to CSW for CKAN """
     def __init__(self, url, schema, version='2.0.2', lang='en-US'):
         self.schema = schema
-        self.catalog = CatalogueServiceWeb(
-            url,
-            lang,
-            version,
-            timeout=10,
-            skip_caps=True
-        )
-        self.metadata = dict.fromkeys([
+        self.catalog = get_catalog(url, lang, version, timeout=10)
+        self.metadata_keys = (
             'id',
             'name',
             'title',
@@ -190,7 +695,12 @@ class CkanMetadata(object):
             'tags',
             'metadata_url',
             'metadata_raw',
-        ])
+        )
+        self._engine = None
+        self.date_stamp_xpath = etree.XPath(
+            'normalize-space(gmd:dateStamp)',
+            namespaces=namespaces
+        )
 
     def get_by_search(self, searchterm, propertyname='csw:AnyText'):
         """ Returns the found csw dataset with the given searchterm """
@@ -206,11 +716,99 @@ class CkanMetadata(object):
             )
         return self.catalog.records
 
+    def iter_ids(self, constraints=None, page_size=100):
+        """
+            Yields the ids of all datasets matching the given list of
+            (propertyname, value) tuples. The result pages are requested
+            one after the other, so only a single page is held in memory.
+        """
+        return self._iter_ids(get_conditions(constraints), page_size)
+
+    def get_modified_since(self, timestamp, constraints=None,
+                           page_size=100, ids=None):
+        """
+            Returns the ids of all datasets modified since the given
+            datetime. constraints is an optional list of
+            (propertyname, value) tuples the datasets must match,
+            ids an optional list of the only datasets to search.
+        """
+        conditions = get_conditions(constraints)
+        conditions.append(get_condition(
+            'PropertyIsGreaterThanOrEqualTo',
+            'Modified',
+            timestamp.strftime('%Y-%m-%d')
+        ))
+        if ids:
+            conditions.append(get_any_condition([
+                get_condition('PropertyIsEqualTo', 'Identifier', dataset_id)
+                for dataset_id in ids
+            ]))
+        return list(self._iter_ids(conditions, page_size))
+
+    def _iter_ids(self, conditions, page_size=100):
+        """
+            Returns the ids of all datasets matching the given
+            OGC filter conditions, one GetRecords page after the other
+        """
+        start_position = 1
+        while True:
+            self.catalog.getrecords(xml=get_records_request(
+                conditions,
+                start_position,
+                page_size
+            ))
+            for identifier in self.catalog._exml.xpath(
+                    '//csw:BriefRecord/dc:identifier/text()',
+                    namespaces=namespaces):
+                yield identifier
+
+            results = self.catalog.results
+            log.debug(
+                "GetRecords page at %s: %s of %s records"
+                % (start_position, results['returned'], results['matches'])
+            )
+            next_record = results['nextrecord']
+            if (results['returned'] == 0 or next_record == 0 or
+                    next_record > results['matches']):
+                break
+            start_position = next_record
+
     def get_by_id(self, id):
         """ Returns the csw dataset with the given id """
         self.catalog.getrecordbyid(id=[id], outputschema=self.schema)
         return self.catalog.response
 
+    def get_by_ids(self, ids, chunk_size=20):
+        """
+            Returns the csw datasets with the given ids as (id, xml) tuples.
+            Up to chunk_size ids are requested in one GetRecordById call,
+            the records are yielded while the response is parsed.
+            Ids not known to the csw are skipped.
+        """
+        ids = list(ids)
+        id_attribute = self.get_attribute('id')
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            log.debug("Requesting %s datasets by id" % len(chunk))
+            for record_xml in self.catalog.iter_records_by_id(
+                    id=chunk, outputschema=self.schema):
+                yield id_attribute.get_value(record_xml, 'de'), record_xml
+
+    def split_records(self, response_xml):
+        """
+            Returns the records of a GetRecordById response
+            as (id, xml) tuples
+        """
+        for record_xml in response_xml:
+            if not isinstance(record_xml.tag, basestring):
+                # skip comments and processing instructions
+                continue
+            record_id = self.get_attribute('id').get_value(
+                xml=record_xml,
+                lang='de'
+            )
+            yield record_id, record_xml
+
     def get_id_by_dataset_name(self, dataset_name):
         """
             Returns the id of a dataset identified by it's name.
@@ -227,29 +825,107 @@ class CkanMetadata(object):
         """
         raise NotImplementedError
 
+    def get_engine(self):
+        """ Returns the engine evaluating the mapping of this metadata """
+        if self._engine is None:
+            self._engine = MappingEngine(dict(
+                (key, self.get_attribute(key)) for key in self.metadata_keys
+            ))
+        return self._engine
+
+    def get_record(self, id):
+        """ Returns the parsed record of the dataset with the given id """
+        for record_id, record_xml in self.get_by_ids([id]):
+            if record_id == id:
+                return record_xml
+        raise DatasetNotFoundError("Dataset with id %s not found" % id)
+
     def get_xml(self, id):
         dataset_xml_string = self.get_by_id(id)
         if dataset_xml_string is None:
             raise DatasetNotFoundError("Dataset with id %s not found" % id)
         return dataset_xml_string
 
-    def get_ckan_metadata_by_id(self, id, language='de'):
+    def get_fingerprint(self, dataset_xml):
+        """
+            Returns a fingerprint of the content of the given record,
+            made of its date stamp and the hash of its canonical XML
+        """
+        date_stamp = self.date_stamp_xpath(dataset_xml)
+        digest = hashlib.sha256(etree.tostring(dataset_xml, method='c14n'))
+        return '%s:%s' % (date_stamp, digest.hexdigest())
+
+    def get_fields(self, fields=None):
+        """ Returns the given metadata keys, all of them by default """
+        if fields is None:
+            return self.metadata_keys
+        for field in fields:
+            if field not in self.metadata_keys:
+                raise AttributeMappingNotFoundError(
+                    "No mapping found for attribute '%s'"
+                    % field
+                )
+        return fields
+
+    def get_ckan_metadata_by_id(self, id, language='de', fields=None):
         log.debug("Dataset ID: %s" % id)
 
-        dataset_xml = etree.fromstring(self.get_xml(id))
-        for key in self.metadata:
-            log.debug("Metadata key: %s" % key)
-            attribute = self.get_attribute(key)
-            self.metadata[key] = attribute.get_value(
-                xml=dataset_xml,
-                lang=language
-            )
-        return self.metadata
+        dataset_xml = self.get_record(id)
+        return self.get_ckan_metadata_by_xml(dataset_xml, language, fields)
+
+    def get_ckan_metadata_by_xml(self, dataset_xml, language='de',
+                                 fields=None):
+        """
+            Returns the given dataset xml mapped to CKAN attributes.
+            Every call returns a new LazyMetadata which only evaluates
+            the requested fields when they are accessed.
+        """
+        return LazyMetadata(
+            self.get_engine(),
+            dataset_xml,
+            language,
+            self.get_fields(fields)
+        )
+
+    def get_ckan_metadata_multilang(self, id, languages=LANGUAGES,
+                                    fields=None):
+        """
+            Returns the requested dataset mapped to CKAN attributes
+            for all given languages, the dataset is only fetched
+            and parsed once.
+        """
+        log.debug("Dataset ID: %s" % id)
+
+        dataset_xml = self.get_record(id)
+        return self.get_ckan_metadata_multilang_by_xml(
+            dataset_xml,
+            languages,
+            fields
+        )
+
+    def get_ckan_metadata_multilang_by_xml(self, dataset_xml,
+                                           languages=LANGUAGES,
+                                           fields=None):
+        """
+            Returns the given dataset xml mapped per language.
+            The anchors and the values not depending on the language
+            are shared by the languages.
+        """
+        engine = self.get_engine()
+        fields = self.get_fields(fields)
+        anchors = AnchorCache(dataset_xml)
+        shared = {}
+        return dict(
+            (lang, LazyMetadata(
+                engine, dataset_xml, lang, fields, anchors, shared
+            ))
+            for lang in languages
+        )
 
-    def get_ckan_metadata(self, dataset_name, language='de'):
+    def get_ckan_metadata(self, dataset_name, language='de', fields=None):
         """ Returns the requested dataset mapped to CKAN attributes """
         id = self.get_id_by_dataset_name(dataset_name)
-        return self.get_ckan_metadata_by_id(id, language)
+        return self.get_ckan_metadata_by_id(id, language, fields)
 
 
 class ZhGisCkanMetadata(CkanMetadata):
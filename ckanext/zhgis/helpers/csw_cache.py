@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from paste.deploy.converters import asbool
+from pylons import config
+import logging
+log = logging.getLogger(__name__)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+        Returns the process-wide CSW response cache or None if
+        ckanext.zhgis.csw_cache_dir is not set
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None and config.get('ckanext.zhgis.csw_cache_dir'):
+            _cache = ResponseCache(
+                config['ckanext.zhgis.csw_cache_dir'],
+                ttl=int(config.get('ckanext.zhgis.csw_cache_ttl', 86400)),
+                max_size=int(
+                    config.get('ckanext.zhgis.csw_cache_max_size', 100)
+                ) * 1024 * 1024,
+                offline=asbool(config.get('ckanext.zhgis.csw_offline', False))
+            )
+    return _cache
+
+
+class ResponseCache(object):
+    """
+        On-disk cache of CSW responses.
+
+        Every entry is stored in its own file named after the hash of the
+        endpoint and the request, so a lookup is a single file access.
+        The first line of a file is the time the response was fetched,
+        the modification time is the last access and is used to evict the
+        least recently used entries once the cache exceeds max_size bytes.
+        In offline mode, all entries are used regardless of their age.
+    """
+    def __init__(self, directory, ttl=86400, max_size=100 * 1024 * 1024,
+                 offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            "<ResponseCache directory:%s ttl:%s max_size:%s offline:%s>"
+            % (self.directory, self.ttl, self.max_size, self.offline)
+        )
+
+    def get_path(self, url, request):
+        key = hashlib.sha1('%s\n%s' % (url, request)).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, url, request):
+        """ Returns the cached response or None """
+        cache_file = self.open(url, request)
+        if cache_file is None:
+            return None
+        with cache_file:
+            return cache_file.read()
+
+    def open(self, url, request):
+        """ Returns the cached response as an open file or None """
+        path = self.get_path(url, request)
+        try:
+            cache_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            fetched = float(cache_file.readline())
+        except ValueError:
+            cache_file.close()
+            return None
+        if not self.offline and time.time() - fetched > self.ttl:
+            log.debug("Cache entry %s expired" % path)
+            cache_file.close()
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        log.debug("Cache hit %s" % path)
+        return cache_file
+
+    def set(self, url, request, response):
+        """ Stores the response and evicts old entries if needed """
+        self.set_stream(url, request, [response]).close()
+
+    def set_stream(self, url, request, chunks):
+        """
+            Stores the response read from the iterable chunks, so it is
+            never held in memory, and returns it as an open file.
+            Old entries are evicted if needed.
+        """
+        path = self.get_path(url, request)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write('%f\n' % time.time())
+                for chunk in chunks:
+                    cache_file.write(chunk)
+        except:
+            os.remove(tmp_path)
+            raise
+        # opened before the rename, so it stays readable when evicted
+        response_file = open(tmp_path, 'rb')
+        response_file.readline()
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.rename(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._get_size()
+            else:
+                size = os.fstat(response_file.fileno()).st_size
+                self._size += size - old_size
+            if self._size > self.max_size:
+                self._evict()
+        return response_file
+
+    def delete(self, url, request):
+        """ Removes the cached response, e.g. an invalid one """
+        path = self.get_path(url, request)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+        log.debug("Deleted cache entry %s" % path)
+
+    def _get_entries(self):
+        entries = []
+        for directory, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    # entries still being written
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _get_size(self):
+        return sum(size for mtime, size, path in self._get_entries())
+
+    def _evict(self):
+        """ Removes the least recently used entries down to 90% of max_size """
+        entries = sorted(self._get_entries())
+        self._size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self._size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            log.debug("Evicted cache entry %s" % path)
+            self._size -= size
+
+
+class CacheMissError(Exception):
+    pass
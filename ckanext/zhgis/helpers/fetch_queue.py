@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from ckanext.harvest.queue import get_fetch_publisher
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class FetchQueue(object):
+    """
+        Collects the ids of the harvest objects saved during gather.
+
+        With a batch_size, every full batch is sent to the fetch queue
+        right away, so fetch and import overlap with gather. The ids of
+        the last, incomplete batch remain in ids and are returned by the
+        gather stage, the harvest queue then sends them as usual.
+        The harvest objects are committed when they are saved, so the
+        fetch consumers can load them as soon as they are sent.
+    """
+    def __init__(self, batch_size=0):
+        self.batch_size = batch_size
+        self.ids = []
+        self.published = 0
+        self._publisher = None
+
+    def __repr__(self):
+        return (
+            "<FetchQueue batch_size:%s pending:%s published:%s>"
+            % (self.batch_size, len(self.ids), self.published)
+        )
+
+    def __len__(self):
+        return self.published + len(self.ids)
+
+    def add(self, harvest_object_id):
+        self.ids.append(harvest_object_id)
+        if self.batch_size and len(self.ids) >= self.batch_size:
+            self.publish()
+
+    def publish(self):
+        """
+            Sends the collected ids to the fetch queue. If this fails,
+            batching is disabled and the unsent ids are kept
+            to be returned by the gather stage.
+        """
+        try:
+            if self._publisher is None:
+                self._publisher = get_fetch_publisher()
+            while self.ids:
+                self._publisher.send({'harvest_object_id': self.ids[0]})
+                self.ids.pop(0)
+                self.published += 1
+        except Exception, e:
+            log.exception(e)
+            log.warning('Sending to the fetch queue failed, batches disabled')
+            self.batch_size = 0
+            return
+        log.debug('%s objects sent to the fetch queue' % self.published)
+
+    def close(self):
+        """ Returns the ids not sent yet """
+        if self._publisher is not None:
+            try:
+                self._publisher.close()
+            except Exception, e:
+                log.exception(e)
+            self._publisher = None
+        return self.ids
@@ -20,10 +20,12 @@ class S3():
             % (self.key, self.token, self.bucket_name)
         )
 
-    def list(self, prefix=None):
+    def get_bucket(self, validate=True):
         conn = S3Connection(self.key, self.token)
-        bucket = conn.get_bucket(self.bucket_name)
-        return bucket.list(prefix=prefix)
+        return conn.get_bucket(self.bucket_name, validate=validate)
+
+    def list(self, prefix=None):
+        return self.get_bucket().list(prefix=prefix)
 
 
 class ConfigEntryNotFoundError(Exception):